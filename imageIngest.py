@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 import sys
+import copy
+import asyncio
+import threading
+import logging
+import logging.handlers
+import queue
+import re
 import yaml
-import datetime
-import os
-from googleapiclient import discovery
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+import httplib2
+import google_auth_httplib2
 import google.auth
+import tenacity
+from googleapiclient import discovery
+from googleapiclient import errors
 #############################################################################################
 # This code is responsible for loading DICOM data from a given study into a set of Google 
 # Health datasets, one for each consent group in the study.  Each patient in the study is 
@@ -22,48 +35,301 @@ import google.auth
 
 # Code credit: https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/healthcare/api-client/v1/datasets/datasets.py
 
+log = logging.getLogger('ingest')
+
+def start_logging(level=logging.INFO):
+    """Routes the ingest log through a queue to a background thread that writes
+    it to stderr, so the worker threads never wait on console output.  Returns
+    the listener, which must be stopped to flush any remaining records, or None
+    if logging was already started.  Records are not passed on to the root
+    logger, so they are not written twice if the caller has configured it."""
+    log.setLevel(level)
+    log.propagate = False
+    if any(isinstance(handler, logging.handlers.QueueHandler)
+           for handler in log.handlers):
+        return None
+
+    logQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(logQueue, handler)
+    log.addHandler(logging.handlers.QueueHandler(logQueue))
+    listener.start()
+    return listener
+
+# Maximum number of consent groups processed at the same time.  Google suggests
+# keeping the number of concurrent Healthcare API requests modest.
+MAX_CONCURRENT_GROUPS = 8
+
+# Socket timeout, in seconds, for Healthcare API requests.
+HTTP_TIMEOUT = 60
+
+# The underlying httplib2 transport is not thread safe, so each worker thread
+# keeps its own client.
+_thread_local = threading.local()
+
+HEALTHCARE_SCOPES = ['https://www.googleapis.com/auth/cloud-healthcare']
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+def get_credentials():
+    """Returns the Application Default Credentials, loading them only once.
+    The credentials and their access token are shared by every client; the
+    token is refreshed shortly before it expires (google-auth's refresh
+    threshold is a few minutes) rather than on every request."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials, _ = google.auth.default(scopes=HEALTHCARE_SCOPES)
+        return _credentials
+
 # [START healthcare_get_client]
 def get_client():
     """Returns an authorized API client by discovering the Healthcare API and
-    creating a service object using the service account credentials in the
-    GOOGLE_APPLICATION_CREDENTIALS environment variable."""
+    creating a service object using the shared Application Default Credentials
+    (see get_credentials).
+    The client is built once per thread and reused by every helper, so the
+    discovery document is only fetched and parsed a handful of times per run."""
     api_version = 'v1'
     service_name = 'healthcare'
 
-    try:
-       return discovery.build(service_name, api_version)
-    except Exception as theException:
-       print (theException)
+    client = getattr(_thread_local, "client", None)
+    if client is not None:
+        return client
+
+    # httplib2 keeps the connection to each host open between requests, so each
+    # thread pays for the TLS handshake with healthcare.googleapis.com only once.
+    http = google_auth_httplib2.AuthorizedHttp(
+       get_credentials(), http=httplib2.Http(cache=None, timeout=HTTP_TIMEOUT))
+    client = discovery.build(service_name, api_version, http=http,
+                             cache_discovery=False, static_discovery=True)
+    _thread_local.client = client
+    return client
 # [END healthcare_get_client]
 
-# [START healthcare_create_dataset]
-def create_dataset(project_id, cloud_region, dataset_id):
-    """Creates a dataset."""
-    client = get_client()
-    dataset_parent = 'projects/{}/locations/{}'.format(
-        project_id, cloud_region)
+# Walking client.projects().locations()... builds a new resource object from the
+# discovery document at every step, so the collections we use are built once per
+# thread as well.
+def get_datasets():
+    """Returns the projects.locations.datasets collection."""
+    datasets = getattr(_thread_local, "datasets", None)
+    if datasets is None:
+        datasets = get_client().projects().locations().datasets()
+        _thread_local.datasets = datasets
+    return datasets
+
+def get_dicom_stores():
+    """Returns the projects.locations.datasets.dicomStores collection."""
+    dicom_stores = getattr(_thread_local, "dicom_stores", None)
+    if dicom_stores is None:
+        dicom_stores = get_datasets().dicomStores()
+        _thread_local.dicom_stores = dicom_stores
+    return dicom_stores
+
+def get_operations():
+    """Returns the projects.locations.datasets.operations collection."""
+    operations = getattr(_thread_local, "operations", None)
+    if operations is None:
+        operations = get_datasets().operations()
+        _thread_local.operations = operations
+    return operations
+
+# HTTP statuses that indicate a transient failure worth retrying.
+RETRIABLE_STATUSES = {429, 500, 503, 504}
+
+# A 500 or 504 can come back after the server has already done the work, so
+# calls that are not safe to repeat (creates and imports) are only retried on
+# statuses that mean the request was not acted on.
+UNSAFE_RETRIABLE_STATUSES = {429, 503}
+
+def is_retriable(exception, statuses=RETRIABLE_STATUSES):
+    """Returns True if the exception is a Healthcare API error with one of the
+    given statuses."""
+    return (isinstance(exception, errors.HttpError)
+            and exception.resp.status in statuses)
+
+def retry_policy(statuses):
+    """Returns the tenacity arguments for retrying errors with the given
+    statuses.  Transient errors are retried with jittered exponential backoff,
+    so a single 503 or a burst of 429s does not throw away the rest of the
+    ingest."""
+    return dict(
+        wait=tenacity.wait_exponential_jitter(initial=1, max=60),
+        stop=tenacity.stop_after_attempt(8),
+        retry=tenacity.retry_if_exception(
+            lambda exception: is_retriable(exception, statuses)),
+        reraise=True)
+
+def execute(request, statuses=RETRIABLE_STATUSES):
+    """Executes an API request, retrying errors with the given statuses."""
+    return tenacity.Retrying(**retry_policy(statuses))(request.execute)
 
+# [START healthcare_create_dataset]
+def create_dataset(dataset_parent, dataset_id):
+    """Creates a dataset under dataset_parent, which is the fully qualified
+    'projects/{project}/locations/{region}' name."""
 #   try:
-    request = client.projects().locations().datasets().create(
+    request = get_datasets().create(
         parent=dataset_parent, body={}, datasetId=dataset_id)
 
-    response = request.execute()
+    response = execute(request, UNSAFE_RETRIABLE_STATUSES)
 #   except Exception as theException:
 #      print(theException)
-    print('Created dataset: {}'.format(dataset_id))
+    log.info('Started creation of dataset: %s', dataset_id)
     return response
 # [END healthcare_create_dataset]
 
+# Google accepts at most this many calls in a single batch HTTP request.
+MAX_BATCH_SIZE = 1000
+
+def execute_batch(requests, statuses=RETRIABLE_STATUSES, already_exists_ok=False):
+    """Executes a {request_id: request} mapping using as few batch HTTP requests
+    as possible and returns a {request_id: response} mapping.  Calls that fail
+    with one of the given statuses are retried in a new batch; any other
+    failure is raised once the whole batch has run, after logging the calls
+    that did succeed.  With already_exists_ok, a create that fails with 409
+    ALREADY_EXISTS counts as done, so a partial run can be repeated; it has no
+    response and is left out of the mapping."""
+    client = get_client()
+    responses = {}
+    pending = dict(requests)
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            responses[request_id] = response
+        elif already_exists_ok and is_retriable(exception, {409}):
+            log.info("%s already exists", request_id)
+        else:
+            failures.append(exception)
+            return
+        del pending[request_id]
+
+    try:
+        for attempt in tenacity.Retrying(**retry_policy(statuses)):
+            with attempt:
+                failures = []
+
+                items = list(pending.items())
+                for start in range(0, len(items), MAX_BATCH_SIZE):
+                    batch = client.new_batch_http_request(callback=callback)
+                    for request_id, request in items[start:start + MAX_BATCH_SIZE]:
+                        batch.add(request, request_id=request_id)
+                    batch.execute()
+
+                # Raise a permanent failure in preference to a transient one, so
+                # we do not retry a batch that can never succeed.
+                failures.sort(key=lambda exception: is_retriable(exception, statuses))
+                if failures:
+                    raise failures[0]
+    except errors.HttpError:
+        for request_id, response in responses.items():
+            log.error("%s succeeded before the batch failed: %s",
+                      request_id, response.get("name", ""))
+        raise
+
+    return responses
+
+# Policy version to request on reads.  Version 3 is needed to see, and write
+# back unchanged, bindings that carry a condition.
+IAM_POLICY_VERSION = 3
+
+def add_iam_members(policy, role, members):
+    """Adds the members to the unconditional binding for role in the policy,
+    keeping all of the existing bindings, and returns the policy.  Conditional
+    bindings for the same role are left alone, so the members get a plain
+    grant rather than a time or attribute limited one.  The policy's version
+    is kept, so it must have been read with IAM_POLICY_VERSION."""
+    bindings = policy.setdefault("bindings", [])
+    for binding in bindings:
+        if binding["role"] == role and "condition" not in binding:
+            binding["members"] = sorted(set(binding.get("members", [])) | set(members))
+            break
+    else:
+        bindings.append({"role": role, "members": sorted(set(members))})
+    return policy
+
+# The last IAM policy, including its etag, that we wrote for each dataset.  A
+# policy we have just written is still current, so a later change to the same
+# dataset in this process can skip reading it again.  main() grants access to
+# each dataset only once, so this only pays off when the IAM helpers are called
+# repeatedly by code that imports this module.
+_policy_cache = {}
+_policy_cache_lock = threading.Lock()
+
+def get_cached_policy(dataset_name):
+    """Returns a copy of the cached policy for the dataset, or None."""
+    with _policy_cache_lock:
+        policy = _policy_cache.get(dataset_name)
+    return copy.deepcopy(policy)
+
+def cache_policy(dataset_name, policy):
+    """Caches a copy of the policy, so later changes to it by the caller do not
+    leak into the cache."""
+    policy = copy.deepcopy(policy)
+    with _policy_cache_lock:
+        _policy_cache[dataset_name] = policy
+
+def forget_policies(dataset_names):
+    with _policy_cache_lock:
+        for dataset_name in dataset_names:
+            _policy_cache.pop(dataset_name, None)
+
+def write_dataset_iam_policies(dataset_members, role):
+    datasets = get_datasets()
+
+    policies = {}
+    for dataset_name in dataset_members:
+        policy = get_cached_policy(dataset_name)
+        if policy is not None:
+            policies[dataset_name] = policy
+    policies.update(execute_batch({
+        dataset_name: datasets.getIamPolicy(
+            resource=dataset_name,
+            options_requestedPolicyVersion=IAM_POLICY_VERSION)
+        for dataset_name in dataset_members if dataset_name not in policies}))
+
+    writes = {}
+    for dataset_name, members in dataset_members.items():
+        policy = add_iam_members(policies[dataset_name], role, members)
+        writes[dataset_name] = datasets.setIamPolicy(
+            resource=dataset_name, body={'policy': policy})
+    responses = execute_batch(writes)
+
+    for dataset_name, response in responses.items():
+        cache_policy(dataset_name, response)
+    return responses
+
+def set_dataset_iam_policies(dataset_members, role):
+    """Grants a role on many datasets at once.  dataset_members maps each fully
+    qualified dataset name to its list of members.
+    The new members are merged into each dataset's current policy, so existing
+    bindings are preserved.  All of the policy reads go out in one batch request
+    and all of the writes in another, rather than two requests per dataset.
+    Each policy's etag guards its write against concurrent modification, and a
+    conflicting write is redone once from a fresh read."""
+    try:
+        responses = write_dataset_iam_policies(dataset_members, role)
+    except errors.HttpError as theException:
+        forget_policies(dataset_members)
+        # A 409 is an etag mismatch on one of the policy writes.
+        if not is_retriable(theException, {409}):
+            raise
+        # Adding members is idempotent, so the whole batch can simply be redone.
+        responses = write_dataset_iam_policies(dataset_members, role)
+
+    for dataset_name, response in responses.items():
+        log.info('%s etag: %s', dataset_name, response.get('etag'))
+        log.debug('%s bindings: %s', dataset_name, response.get('bindings'))
+    return responses
+
 # [START healthcare_dataset_set_iam_policy]
 def set_dataset_iam_policy(
-        project_id,
-        cloud_region,
-        dataset_id,
+        dataset_name,
         member,
-        role,
-        etag=None):
-    """Sets the IAM policy for the specified dataset.
-        A single member will be assigned a single role. A member can be any of:
+        role):
+    """Grants a role on the specified fully qualified dataset.
+        The member may be a single member or a list of members. A member can be any of:
         - allUsers, that is, anyone
         - allAuthenticatedUsers, anyone authenticated with a Google account
         - user:email, as in 'user:somebody@example.com'
@@ -73,95 +339,128 @@ def set_dataset_iam_policy(
             as in 'serviceAccount:my-other-app@appspot.gserviceaccount.com'
         A role can be any IAM role, such as 'roles/viewer', 'roles/owner',
         or 'roles/editor'
+        This is set_dataset_iam_policies for a single dataset.
     """
-    client = get_client()
-    dataset_name = 'projects/{}/locations/{}/datasets/{}'.format(
-        project_id, cloud_region, dataset_id)
-
-    policy = {
-        "bindings": [
-            {
-                "role": role,
-                "members": [
-                    member
-                ]
-            }
-        ]
-    }
-
-    if etag is not None:
-        policy['etag'] = etag
-
-    request = client.projects().locations().datasets().setIamPolicy(
-        resource=dataset_name, body={'policy': policy})
-    response = request.execute()
-
-    print('etag: {}'.format(response.get('name')))
-    print('bindings: {}'.format(response.get('bindings')))
-    return response
+    members = [member] if isinstance(member, str) else member
+    return set_dataset_iam_policies({dataset_name: members}, role)[dataset_name]
 # [END healthcare_dataset_set_iam_policy]
 
 # Code credit:  https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/healthcare/api-client/v1/datasets/datasets.py
 # [START healthcare_create_dicom_store]
-def create_dicom_store(project_id, cloud_region, dataset_id, dicom_store_id):
-    """Creates a new DICOM store within the parent dataset."""
-    client = get_client()
-    dicom_store_parent = "projects/{}/locations/{}/datasets/{}".format(
-        project_id, cloud_region, dataset_id
-    )
-
-    request = (
-        client.projects()
-        .locations()
-        .datasets()
-        .dicomStores()
-        .create(parent=dicom_store_parent, body={}, dicomStoreId=dicom_store_id)
-    )
-
-    response = request.execute()
-    print("Created DICOM store: {}".format(dicom_store_id))
+def create_dicom_store(dicom_store_parent, dicom_store_id):
+    """Creates a new DICOM store within the fully qualified parent dataset."""
+    request = get_dicom_stores().create(
+        parent=dicom_store_parent, body={}, dicomStoreId=dicom_store_id)
+
+    response = execute(request, UNSAFE_RETRIABLE_STATUSES)
+    log.info("Created DICOM store: %s", dicom_store_id)
     return response
 # [END healthcare_create_dicom_store]
 
+def create_datasets(dataset_parent, dataset_ids):
+    """Starts creating several datasets under dataset_parent using a single
+    batch request.  Dataset creation is a long-running operation; returns a
+    {dataset_id: operation} mapping.  Datasets that already exist, say from an
+    earlier partial run, are skipped and have no operation."""
+    datasets = get_datasets()
+
+    responses = execute_batch({
+        dataset_id: datasets.create(
+            parent=dataset_parent, body={}, datasetId=dataset_id)
+        for dataset_id in dataset_ids}, UNSAFE_RETRIABLE_STATUSES,
+        already_exists_ok=True)
+    for dataset_id in responses:
+        log.info('Started creation of dataset: %s', dataset_id)
+    return responses
+
+def create_dicom_stores(dicom_stores):
+    """Creates several DICOM stores using a single batch request.  dicom_stores
+    maps each fully qualified DICOM store name to a (fully qualified parent
+    dataset, DICOM store id) pair.  The parent datasets must already exist; the
+    calls in a batch may run in any order, so datasets and their stores cannot
+    be created in the same batch.  Stores that already exist are skipped."""
+    stores = get_dicom_stores()
+
+    responses = execute_batch({
+        dicom_store_name: stores.create(
+            parent=dicom_store_parent, body={}, dicomStoreId=dicom_store_id)
+        for dicom_store_name, (dicom_store_parent, dicom_store_id)
+        in dicom_stores.items()}, UNSAFE_RETRIABLE_STATUSES,
+        already_exists_ok=True)
+    for dicom_store_name in responses:
+        log.info("Created DICOM store: %s", dicom_store_name)
+    return responses
+
 # Code credit:  https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/healthcare/api-client/v1/dicom/dicom_stores.py
 # [START healthcare_import_dicom_instance]
-def import_dicom_instance(
-    project_id, cloud_region, dataset_id, dicom_store_id, content_uri
-):
-    """Import data into the DICOM store by copying it from the specified
-    source.
+def import_dicom_instance(dicom_store_name, content_uri):
+    """Import data into the fully qualified DICOM store by copying it from the
+    specified source.
+    The source must be a wildcard pattern such as 'bucket/prefix/**.dcm' so
+    that a single import operation covers every object for the store.  Files
+    should be staged under one prefix before calling this; importing objects
+    one at a time is not supported.
     """
-    client = get_client()
-    dicom_store_parent = "projects/{}/locations/{}/datasets/{}".format(
-        project_id, cloud_region, dataset_id
-    )
-    dicom_store_name = "{}/dicomStores/{}".format(dicom_store_parent, dicom_store_id)
+    if "*" not in content_uri:
+        raise ValueError(
+            "DICOM imports must use a wildcard pattern, not a single object: {}".format(
+                content_uri))
 
     body = {"gcsSource": {"uri": "gs://{}".format(content_uri)}}
 
     # Escape "import()" method keyword because "import"
     # is a reserved keyword in Python
-    request = (
-        client.projects()
-        .locations()
-        .datasets()
-        .dicomStores()
-        .import_(name=dicom_store_name, body=body)
-    )
+    request = get_dicom_stores().import_(name=dicom_store_name, body=body)
 
-    response = request.execute()
-    print("Imported DICOM instance: {}".format(content_uri))
+    response = execute(request, UNSAFE_RETRIABLE_STATUSES)
+    log.info("Started import of DICOM instances: %s", content_uri)
+    log.info("Operation: %s", response.get("name"))
 
     return response
 
 
 # [END healthcare_import_dicom_instance]
 
+# [START healthcare_get_operation]
+def get_operation(operation_name):
+    """Gets the current state of a long-running operation."""
+    request = get_operations().get(name=operation_name)
+
+    return execute(request)
+
+
+# [END healthcare_get_operation]
+
+# Bounds, in seconds, for the exponential backoff used when polling operations.
+POLL_INITIAL_DELAY = 1
+POLL_MAX_DELAY = 30
+
+async def wait_for_operation(operation_name):
+    """Polls a long-running operation with exponential backoff until it is done
+    and returns the final operation.  Sleeping happens on the event loop, so
+    any number of operations can be waited on concurrently."""
+    delay = POLL_INITIAL_DELAY
+    while True:
+        operation = await asyncio.to_thread(get_operation, operation_name)
+        if operation.get("done"):
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+    if "error" in operation:
+        log.error("Operation %s failed: %s", operation_name, operation["error"])
+    else:
+        log.info("Operation %s complete", operation_name)
+    return operation
+
+async def poll_operations(operation_names):
+    """Waits for all of the given long-running operations to finish."""
+    return await asyncio.gather(
+        *(wait_for_operation(name) for name in operation_names))
+
 # [START healthcare_dicom_store_set_iam_policy]
-def set_dicom_store_iam_policy(
-    project_id, cloud_region, dataset_id, dicom_store_id, member, role, etag=None
-):
-    """Sets the IAM policy for the specified dicom store.
+def set_dicom_store_iam_policy(dicom_store_name, member, role, etag=None):
+    """Sets the IAM policy for the specified fully qualified dicom store.
         A single member will be assigned a single role. A member can be any of:
         - allUsers, that is, anyone
         - allAuthenticatedUsers, anyone authenticated with a Google account
@@ -173,99 +472,205 @@ def set_dicom_store_iam_policy(
         A role can be any IAM role, such as 'roles/viewer', 'roles/owner',
         or 'roles/editor'
     """
-    client = get_client()
-    dicom_store_parent = "projects/{}/locations/{}/datasets/{}".format(
-        project_id, cloud_region, dataset_id
-    )
-    dicom_store_name = "{}/dicomStores/{}".format(dicom_store_parent, dicom_store_id)
-
     policy = {"bindings": [{"role": role, "members": [member]}]}
 
     if etag is not None:
         policy["etag"] = etag
 
-    request = (
-        client.projects()
-        .locations()
-        .datasets()
-        .dicomStores()
-        .setIamPolicy(resource=dicom_store_name, body={"policy": policy})
-    )
-    response = request.execute()
-
-    print("etag: {}".format(response.get("name")))
-    print("bindings: {}".format(response.get("bindings")))
+    request = get_dicom_stores().setIamPolicy(
+        resource=dicom_store_name, body={"policy": policy})
+    response = execute(request)
+
+    log.info("etag: %s", response.get("etag"))
+    log.debug("bindings: %s", response.get("bindings"))
     return response
 
 
 # [END healthcare_dicom_store_set_iam_policy]
 
-def main():
+def import_consent_group(dataStoreName, uri):
+   """Starts the import for a single consent group and returns the name of the
+   import operation.  This blocks on the API call, so it is run on a worker
+   thread."""
+   # The import is a long-running operation; we only start it here and wait for it
+   # once every consent group has been kicked off.
+   operation = import_dicom_instance(dataStoreName, uri)
+   return operation["name"]
+
+# Deliberately loose: catches typos and stray values without trying to be RFC 5322.
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# study.id and the consent group keys become part of the dataset and dicom store
+# ids, which may only use these characters and are at most 256 characters long.
+RESOURCE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+MAX_RESOURCE_ID_LENGTH = 256
+
+def is_valid_id_part(value):
+   return isinstance(value, str) and RESOURCE_ID_PATTERN.match(value) is not None
+
+def is_valid_email(email):
+   return isinstance(email, str) and EMAIL_PATTERN.match(email.strip()) is not None
+
+def validate_manifest(parsedYaml):
+   """Checks the parsed yaml in a single pass and returns a list of problems, so a
+   bad manifest is rejected before any API call is made."""
+   if not isinstance(parsedYaml, dict):
+      return ["the manifest must be a mapping"]
+
+   problems = []
+   for field in ("project", "region"):
+      if not isinstance(parsedYaml.get(field), str):
+         problems.append(f"'{field}' must be a string")
+
+   study = parsedYaml.get("study")
+   if not isinstance(study, dict):
+      return problems + ["'study' must be a mapping"]
+   studyId = study.get("id")
+   if not is_valid_id_part(studyId):
+      problems.append(f"'study.id' {studyId!r} must be a string of letters, digits, '_', '.' or '-'")
+      studyId = ""
+
+   consentGroups = study.get("consent-groups")
+   if not isinstance(consentGroups, list):
+      return problems + ["'study.consent-groups' must be a list"]
+
+   seenKeys = set()
+   for thisConsentGroup in consentGroups:
+      if not isinstance(thisConsentGroup, dict):
+         problems.append(f"consent group {thisConsentGroup!r} must be a mapping")
+         continue
+      for key, allowedEmails in thisConsentGroup.items():
+         if not is_valid_id_part(key):
+            problems.append(f"consent group {key!r} must be named with letters, digits, '_', '.' or '-'")
+         elif len(f"dataset--{studyId}--{key}") > MAX_RESOURCE_ID_LENGTH:
+            problems.append(f"consent group '{key}' makes a dataset id longer than "
+                            f"{MAX_RESOURCE_ID_LENGTH} characters")
+         if key in seenKeys:
+            problems.append(f"consent group '{key}' appears more than once")
+         seenKeys.add(key)
+         if not isinstance(allowedEmails, list) or not allowedEmails:
+            problems.append(f"consent group '{key}' must list the allowed emails")
+            continue
+         for thisEmail in allowedEmails:
+            if not is_valid_email(thisEmail):
+               problems.append(f"consent group '{key}' has an invalid email {thisEmail!r}")
+   return problems
+
+async def main():
 
    if len(sys.argv) < 2:
-      print ("usage: imageIngest.py yamlFile")
+      log.error("usage: imageIngest.py yamlFile")
       return
 
    thisExecutable = sys.argv[0]
    yamlFile = sys.argv[1]
 
-   # Open the input yamlFile
-   inFile = open(yamlFile)
-
-   # 1) Read the yaml file and grab the scripts and shortcuts
-   parsedYaml = yaml.load(inFile, Loader=yaml.FullLoader)
-   print (parsedYaml)
-   print (parsedYaml["study"])
+   # 1) Read the yaml file and grab the scripts and shortcuts.  The safe loader never
+   #    constructs arbitrary Python objects, and the libyaml based one, when PyYAML
+   #    was built with it, is much faster than the pure Python one.
+   with open(yamlFile) as inFile:
+      try:
+         parsedYaml = yaml.load(inFile, Loader=SafeLoader)
+      except yaml.YAMLError as theException:
+         log.error("%s: %s", yamlFile, theException)
+         sys.exit(f"{yamlFile} is not valid yaml")
+   log.debug(parsedYaml)
+   problems = validate_manifest(parsedYaml)
+   if problems:
+      for problem in problems:
+         log.error("%s: %s", yamlFile, problem)
+      sys.exit(f"{yamlFile} is not a valid manifest")
+   log.debug(parsedYaml["study"])
    study  =  (parsedYaml["study"])
-   print (study["id"])
+   log.debug(study["id"])
    project = parsedYaml["project"]
    region =  parsedYaml["region"]
    studyId = study["id"]
-   print ("project " + project + " studyId " + studyId)
+   log.info("project %s studyId %s", project, studyId)
 
    consentGroups = study["consent-groups"]
-   print (consentGroups)
+   log.debug(consentGroups)
 
    # 2) The consent groups are currently in the yaml. These may eventually come from the 
-   #    telemetry file
-   for i in range(len(consentGroups)):
-      thisConsentGroup = consentGroups[i]
+   #    telemetry file.  Work out every name we need up front, so the API calls below
+   #    only ever see fully qualified names.
+   #    Note that we are assuming that the datastore name and the bucket name are the
+   #    same, and that all of the group's files are in that bucket, so one wildcard
+   #    import covers the whole store.
+   datasetParent = f"projects/{project}/locations/{region}"
+   groups = []
+   for thisConsentGroup in consentGroups:
       for key in thisConsentGroup:
-         print (key)
-
-         # Create the requested dataset.
-         thisDataSetName = "dataset--" + studyId + "--" + key
-         create_dataset(project, region, thisDataSetName)
-
-         thisDataStoreName = studyId + "--" + key
-         print (thisDataSetName)
-
-         # Create the dicom store
-         create_dicom_store(project, region, thisDataSetName, thisDataStoreName)
-
-         # 3) Import the data.  Note that we are assuming that the datastore name and the 
-         # bucket name are the same
-         uri = thisDataStoreName + "/**.dcm"
-         import_dicom_instance(project, region, thisDataSetName, thisDataStoreName, uri)
-         print (type(thisConsentGroup[key]))
-         print (thisConsentGroup[key])
-         # The values of the key are the address we want to allow to view the data.
-         userList = []
-         allowedEmails = thisConsentGroup.get(key)
-         for thisEmail in allowedEmails:
-            thisUserEmail = "user:" + thisEmail
-            print ("Giving permission to " + thisEmail + " as " + thisUserEmail)
-            userList.append(thisUserEmail)
-
-         # Note that the documentation for this Google function says it sets a single
-         # member to a single role. In fact if you pass a list, it adds the role
-         # for each member of the list.
-         # It may be that we are going to want to use groups instead of individual accounts,
-         # but it works for the moment.
-         set_dataset_iam_policy( project, 
-                                     region, 
-                                     thisDataSetName, 
-                                     userList, "roles/viewer", etag=None)
+         dataSetId = f"dataset--{studyId}--{key}"
+         dataStoreId = f"{studyId}--{key}"
+         dataSetName = f"{datasetParent}/datasets/{dataSetId}"
+         groups.append({
+            "key": key,
+            "dataSetId": dataSetId,
+            "dataSetName": dataSetName,
+            "dataStoreId": dataStoreId,
+            "dataStoreName": f"{dataSetName}/dicomStores/{dataStoreId}",
+            "uri": f"{dataStoreId}/**.dcm",
+            "allowedEmails": thisConsentGroup[key],
+         })
+         log.debug(dataSetName)
+
+   # Create a dataset and a dicom store for each group, batching all of the datasets
+   # into one request and all of the stores into another.  Creating a dataset is a
+   # long-running operation, and the stores can only be created once it is done.
+   datasetOperations = await asyncio.to_thread(create_datasets, datasetParent,
+                                               [group["dataSetId"] for group in groups])
+   failed = [op for op in datasetOperations.values() if op.get("done") and "error" in op]
+   for op in failed:
+      log.error("Operation %s failed: %s", op["name"], op["error"])
+   operations = await poll_operations(
+      [op["name"] for op in datasetOperations.values() if not op.get("done")])
+   failed += [op for op in operations if "error" in op]
+   if failed:
+      sys.exit("{} of {} datasets could not be created".format(
+         len(failed), len(datasetOperations)))
+   await asyncio.to_thread(create_dicom_stores, {
+      group["dataStoreName"]: (group["dataSetName"], group["dataStoreId"])
+      for group in groups})
+
+   # 3) Import the data.  Each group is independent of the others, so the imports are
+   #    started concurrently, with at most MAX_CONCURRENT_GROUPS in flight at once.
+   semaphore = asyncio.Semaphore(MAX_CONCURRENT_GROUPS)
+
+   async def run_group(group):
+      async with semaphore:
+         log.info("Consent group %s", group["key"])
+         return await asyncio.to_thread(import_consent_group,
+                                        group["dataStoreName"], group["uri"])
+
+   operationNames = await asyncio.gather(
+      *(asyncio.create_task(run_group(group)) for group in groups))
+
+   # 4) Give the users access to their datasets.
+   datasetMembers = {}
+   for group in groups:
+      allowedEmails = group["allowedEmails"]
+      log.debug(allowedEmails)
+      # The values of the key are the address we want to allow to view the data.
+      # Emails are case insensitive, so normalize them to avoid duplicate members.
+      userSet = {f"user:{thisEmail.strip().lower()}" for thisEmail in allowedEmails}
+      for thisUserEmail in sorted(userSet):
+         log.info("Giving permission to %s", thisUserEmail)
+      datasetMembers[group["dataSetName"]] = sorted(userSet)
+
+   # It may be that we are going to want to use groups instead of individual accounts,
+   # but it works for the moment.
+   await asyncio.to_thread(set_dataset_iam_policies, datasetMembers, "roles/viewer")
+
+   # Wait for all of the imports, which run in parallel on the Google side.
+   operations = await poll_operations(operationNames)
+   failed = [op["name"] for op in operations if "error" in op]
+   if failed:
+      sys.exit("{} of {} imports failed".format(len(failed), len(operations)))
 
 if __name__ == "__main__":
-   main()
+   listener = start_logging()
+   try:
+      asyncio.run(main())
+   finally:
+      listener.stop()